@@ -12,9 +12,38 @@ See the emitter documentation for additional optional settings.
 Version: 0.9.2
 """
 
+import atexit
+import errno
+import logging
 import socket
 import sys
 
+# NOTE: send_metric() and everything it calls run once per metric, often
+# thousands of times per flush.  Do not add logging there; log (and format
+# log messages) only once per __call__, guarded by log.isEnabledFor() for
+# debug output.
+
+# characters removed by emitter.sanitize() and the equivalent unicode
+# translate table (unicode.translate() does not take a deletechars argument)
+_SANITIZE_CHARS = '[]"'
+_SANITIZE_UNICODE_TABLE = dict((ord(char), None) for char in _SANITIZE_CHARS)
+
+# fixed parts of a metric line (see emitter.send_metric)
+_SP = b' '
+_SRC_PRE = b' source="'
+_Q = b'"'
+_NL = b'\n'
+
+# socket option that holds back partial TCP segments until it is cleared
+# (Linux: TCP_CORK, BSD/OS X: TCP_NOPUSH; None if neither is available)
+_TCP_CORK = getattr(socket, 'TCP_CORK', getattr(socket, 'TCP_NOPUSH', None))
+
+# prefixes of the top level collector keys sent as system.* metrics
+_SYS_PREFIXES = ('cpu', 'mem')
+
+# cache of camel-case key => dotted name (see convert_key_to_dotted_name)
+_dotted_name_cache = {}
+
 # pylint: disable=invalid-name
 class emitter(object):
     """
@@ -40,56 +69,67 @@ class emitter(object):
         self.proxy_dry_run = True
         self.sock = None
         self.point_tags = {}
+        self._point_tags_str_cache = None
+        self._point_tags_dirty = True
         self.source_tags = []
         self.meta_tags = []
+        self.proxy_host = None
+        self.proxy_port = 2878
+        self._configured = False
+        self._pending = []
+        atexit.register(self._close)
 
-    # pylint: disable=too-many-branches
-    def __call__(self, message, log, agent_config):
+    def _configure(self, agent_config, log):
         """
-        __call__ is called by DataDog when executing the custom emitter(s)
+        Reads the wf_* settings from the agent configuration.  The agent
+        configuration does not change while the agent is running, so this is
+        only done on the first call; later calls return immediately.
         Arguments:
-        message - a JSON object representing the message sent to datadoghq
-        log - the log object
         agent_config - the agent configuration object
+        log - the log object
+        Returns:
+        True if the emitter is configured, False if wf_host is missing
         """
 
-        # configuration
+        if self._configured:
+            return True
+
         if 'wf_host' not in agent_config:
             log.error('Agent config missing wf_host (the Wavefront proxy host)')
-            return
-        proxy_host = agent_config['wf_host']
+            return False
+        self.proxy_host = agent_config['wf_host']
         if 'wf_port' in agent_config:
-            proxy_port = int(agent_config['wf_port'])
-        else:
-            proxy_port = 2878
+            self.proxy_port = int(agent_config['wf_port'])
         self.proxy_dry_run = ('wf_dry_run' in agent_config and
                               (agent_config['wf_dry_run'] == 'yes' or
                                agent_config['wf_dry_run'] == 'true'))
-        if log:
-            log.debug('Wavefront Emitter %s:%d ', proxy_host, proxy_port)
-
         if 'wf_meta_tags' in agent_config:
             self.meta_tags = [tag.strip() for tag in
                               agent_config['wf_meta_tags'].split(',')]
 
+        self._configured = True
+        return True
+
+    def __call__(self, message, log, agent_config):
+        """
+        __call__ is called by DataDog when executing the custom emitter(s)
+        Arguments:
+        message - a JSON object representing the message sent to datadoghq
+        log - the log object
+        agent_config - the agent configuration object
+        """
+
+        # configuration
+        if not self._configure(agent_config, log):
+            return
+        if log and log.isEnabledFor(logging.DEBUG):
+            log.debug('Wavefront Emitter %s:%d ',
+                      self.proxy_host, self.proxy_port)
+
         try:
-            # connect to the proxy
-            if not self.proxy_dry_run:
-                self.sock = socket.socket()
-                self.sock.settimeout(10.0)
-                try:
-                    self.sock.connect((proxy_host, proxy_port))
-                except socket.error as sock_err:
-                    err_str = (
-                        'Wavefront Emitter: Unable to connect %s:%d: %s' %
-                        (proxy_host, proxy_port, str(sock_err)))
-                    if log:
-                        log.error(err_str)
-                    else:
-                        print err_str
-                    return
-            else:
-                self.sock = None
+            # connect to the proxy (the connection is kept between calls)
+            if not self.proxy_dry_run and not self._ensure_connected(log):
+                return
 
             # parse the message
             if 'series' in message:
@@ -107,10 +147,88 @@ class emitter(object):
                     str(exc[1]), str(message))
 
         finally:
-            # close the socket (if open)
-            if self.sock is not None and not self.proxy_dry_run:
-                self.sock.shutdown(socket.SHUT_RDWR)
-                self.sock.close()
+            # send the buffered lines (nothing to do for an empty message)
+            if self._pending:
+                self._flush(log)
+
+    @staticmethod
+    def _log_error(log, err_str):
+        """
+        Logs an error, or prints it if there is no log object.
+        Arguments:
+        log - the log object (or None)
+        err_str - the error message
+        """
+
+        if log:
+            log.error(err_str)
+        else:
+            print err_str
+
+    def _ensure_connected(self, log):
+        """
+        Connects to the proxy unless a connection from a previous call is
+        still open.  A saved connection that the proxy has since closed
+        (e.g., the proxy restarted or dropped the idle connection) is
+        replaced with a new one.
+        Arguments:
+        log - the log object
+        Returns:
+        True if connected, False if the connection attempt failed
+        """
+
+        if self.sock is not None:
+            if not self._peer_closed():
+                return True
+            self._close()
+
+        sock = socket.socket()
+        sock.settimeout(10.0)
+        try:
+            sock.connect((self.proxy_host, self.proxy_port))
+        except socket.error as sock_err:
+            sock.close()
+            self._log_error(log, (
+                'Wavefront Emitter: Unable to connect %s:%d: %s' %
+                (self.proxy_host, self.proxy_port, str(sock_err))))
+            return False
+
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock = sock
+        return True
+
+    def _peer_closed(self):
+        """
+        Checks whether the proxy closed the saved connection.  The proxy never
+        sends anything back, so a non-blocking peek that returns an empty
+        string (EOF) or fails with anything but EAGAIN/EWOULDBLOCK means the
+        connection is gone.  (select() is not used since it cannot handle
+        file descriptors >= FD_SETSIZE in a long running agent.)
+        Returns:
+        True if the connection can no longer be used
+        """
+
+        timeout = self.sock.gettimeout()
+        self.sock.setblocking(0)
+        try:
+            return self.sock.recv(1, socket.MSG_PEEK) == b''
+        except socket.error as sock_err:
+            return sock_err.errno not in (errno.EAGAIN, errno.EWOULDBLOCK)
+        finally:
+            self.sock.settimeout(timeout)
+
+    def _close(self):
+        """
+        Closes the connection to the proxy (if open).  Registered with atexit
+        so the connection is closed cleanly when the agent exits.
+        """
+
+        if self.sock is None:
+            return
+        sock = self.sock
+        self.sock = None
+        sock.close()
 
     def parse_dogstatsd(self, message):
         """
@@ -126,20 +244,28 @@ class emitter(object):
             tags = {}
             if jtags:
                 for tag in jtags:
-                    parts = tag.split(':')
-                    tags[parts[0]] = parts[1]
+                    k, sep, v = tag.partition(':')
+                    if sep:
+                        tags[k] = v
 
             host_name = metric['host']
             jpoints = metric['points']
-            for point in jpoints:
-                tstamp = point[0]
-                value = point[1]
-                self.send_metric(name, value, tstamp, host_name, tags)
+            for tstamp, value in jpoints:
+                self.send_metric(
+                    name, value, str(long(tstamp)), host_name, tags)
 
     # pylint: disable=too-many-arguments
-    def send_metric(self, name, value, tstamp, host_name, tags):
+    def send_metric(self, name, value, tstamp_str, host_name, tags):
         """
-        Sends a metric to the proxy
+        Sends a metric to the proxy.  Lines are buffered and sent in a single
+        batch by _flush() at the end of __call__.
+        Arguments:
+        name - the metric name
+        value - the metric value (the metric is skipped if None)
+        tstamp_str - the timestamp (epoch seconds) already converted to a
+                     string of the integer value, e.g. str(long(tstamp))
+        host_name - the source, or '=<tag key>' to use the value of that tag
+        tags - dictionary of tag key => tag value (or None)
         """
 
         if value is None:
@@ -149,14 +275,106 @@ class emitter(object):
             skip_tag_key = host_name[1:]
             host_name = tags[skip_tag_key]
 
-        tag_str = (emitter.build_tag_string(tags, skip_tag_key) +
-                   emitter.build_tag_string(self.point_tags, skip_tag_key))
-        line = ('%s %s %d source="%s"%s' %
-                (name, value, long(tstamp), host_name, tag_str))
-        if self.proxy_dry_run or not self.sock:
-            print line
+        self._send_metric_with_tag_string(
+            name, value, tstamp_str, host_name,
+            emitter.build_tag_string(tags, skip_tag_key), skip_tag_key)
+
+    # pylint: disable=too-many-arguments
+    def _send_metric_with_tag_string(self, name, value, tstamp_str,
+                                     host_name, tag_str, skip_tag_key):
+        """
+        Same as send_metric() but takes the metric's tags already rendered
+        by build_tag_string(), so callers sending many metrics with the same
+        tags only build the tag string once.
+        Arguments:
+        name - the metric name
+        value - the metric value (the metric is skipped if None)
+        tstamp_str - the timestamp (epoch seconds) already converted to a
+                     string of the integer value, e.g. str(long(tstamp))
+        host_name - the source (already resolved, no '=<tag key>' form)
+        tag_str - the rendered tags (the point tags are appended to these)
+        skip_tag_key - point tag to skip (None to not skip any)
+        """
+
+        # send_metric() has already skipped None values; this is for the
+        # callers that use this method directly (iostats)
+        if value is None:
+            return
+        parts = [name, _SP, str(value), _SP, tstamp_str,
+                 _SRC_PRE, host_name, _Q, tag_str,
+                 self._point_tags_string(skip_tag_key),
+                 _NL]
+        line = b''.join(parts)
+        if self.proxy_dry_run:
+            sys.stdout.write(line)
+        elif isinstance(line, unicode):
+            # names/tags decoded from the JSON message are unicode
+            self._pending.append(line.encode('utf-8'))
         else:
-            self.sock.sendall('%s\n' % (line))
+            self._pending.append(line)
+
+    def _flush(self, log):
+        """
+        Sends all buffered metric lines to the proxy in a single sendall()
+        and clears the buffer.  If the send fails, reconnects and sends the
+        batch once more before dropping it.
+        Arguments:
+        log - the log object
+        """
+
+        count = len(self._pending)
+        data = b''.join(self._pending)
+        self._pending = []
+        for retry in (True, False):
+            try:
+                self._set_cork(True)
+                self.sock.sendall(data)
+                self._set_cork(False)
+                return
+            except socket.error as sock_err:
+                self._log_error(log, (
+                    'Wavefront Emitter: Unable to send to %s:%d: %s' %
+                    (self.proxy_host, self.proxy_port, str(sock_err))))
+                self._close()
+            if not retry or not self._ensure_connected(log):
+                break
+
+        self._log_error(log, ('Wavefront Emitter: Dropped %d metrics' % count))
+
+    def _set_cork(self, cork):
+        """
+        Sets or clears TCP_CORK (TCP_NOPUSH) on the connection so that the
+        batched lines go out in full segments.  Clearing it sends any
+        partial segment right away.  Does nothing if the platform has
+        neither option.
+        Arguments:
+        cork - True to set, False to clear
+        """
+
+        if _TCP_CORK is None:
+            return
+        try:
+            self.sock.setsockopt(socket.IPPROTO_TCP, _TCP_CORK, int(cork))
+        except socket.error:
+            pass
+
+    def _point_tags_string(self, skip_tag_key):
+        """
+        Returns the tag string for self.point_tags.  The point tags rarely
+        change, so the string is cached until parse_host_tags() or
+        parse_meta_tags() modifies them.
+        Arguments:
+        skip_tag_key - skip tag named this (None to not skip any)
+        """
+
+        if skip_tag_key is not None and skip_tag_key in self.point_tags:
+            return emitter.build_tag_string(self.point_tags, skip_tag_key)
+
+        if self._point_tags_dirty:
+            self._point_tags_str_cache = emitter.build_tag_string(
+                self.point_tags, None)
+            self._point_tags_dirty = False
+        return self._point_tags_str_cache
 
     @staticmethod
     def build_tag_string(tags, skip_tag_key):
@@ -172,13 +390,15 @@ class emitter(object):
         if not tags:
             return ''
 
-        tag_str = ''
+        parts = []
         for tag_key, tag_value in tags.iteritems():
+            # self.point_tags only holds strings, but the collector metric
+            # tags also include None/list values (device_name, tags, ...)
             if not isinstance(tag_value, basestring) or tag_key == skip_tag_key:
                 continue
-            tag_str = tag_str + ' "%s"="%s"' % (tag_key, tag_value)
+            parts.extend((' "', tag_key, '"="', tag_value, '"'))
 
-        return tag_str
+        return ''.join(parts)
 
     @staticmethod
     def convert_key_to_dotted_name(key):
@@ -186,12 +406,18 @@ class emitter(object):
         Convert a key that is camel-case notation to a dotted equivalent.
         This is best described with an example: key = "memPhysFree"
         returns "mem.phys.free"
+        The collector sends the same keys on every flush, so the results are
+        cached in _dotted_name_cache.
         Arguments:
         key - a camel-case string value
         Returns:
         dotted notation with each uppercase containing a dot before
         """
 
+        dotted = _dotted_name_cache.get(key)
+        if dotted is not None:
+            return dotted
+
         buf = []
         for char in key:
             if char.isupper():
@@ -199,7 +425,9 @@ class emitter(object):
                 buf.append(char.lower())
             else:
                 buf.append(char)
-        return ''.join(buf)
+        dotted = ''.join(buf)
+        _dotted_name_cache[key] = dotted
+        return dotted
 
     # pylint: disable=too-many-locals
     def parse_collector(self, message):
@@ -240,31 +468,33 @@ class emitter(object):
         message - a JSON object representing the message sent to datadoghq
         """
 
-        tstamp = long(message['collection_timestamp'])
+        tstamp_str = str(long(message['collection_timestamp']))
         host_name = message['internalHostname']
 
         # cpu* mem*
         for key, value in message.iteritems():
-            if key[0:3] == 'cpu' or key[0:3] == 'mem':
+            if key.startswith(_SYS_PREFIXES):
                 dotted = 'system.' + emitter.convert_key_to_dotted_name(key)
-                self.send_metric(dotted, value, tstamp, host_name, None)
+                self.send_metric(dotted, value, tstamp_str, host_name, None)
 
         # metrics
         metrics = message['metrics']
-        for metric in metrics:
+        for name, mtstamp, value, mtags in metrics:
             self.send_metric(
-                metric[0], metric[2], long(metric[1]), '=hostname', metric[3])
+                name, value, str(long(mtstamp)), '=hostname', mtags)
 
         # iostats
         iostats = message['ioStats']
         for disk_name, stats in iostats.iteritems():
+            disk_tag_str = emitter.build_tag_string({'disk': disk_name}, None)
             for name, value in stats.iteritems():
                 name = (name.replace('%', '')
                         .replace('/', '_'))
 
                 metric_name = ('system.io.%s' % (name, ))
-                tags = {'disk': disk_name}
-                self.send_metric(metric_name, value, tstamp, host_name, tags)
+                self._send_metric_with_tag_string(
+                    metric_name, value, tstamp_str, host_name, disk_tag_str,
+                    None)
 
         # count processes
         processes = message['processes']
@@ -272,7 +502,7 @@ class emitter(object):
         # host_name = processes['host']
         metric_name = 'system.processes.count'
         value = len(processes['processes'])
-        self.send_metric(metric_name, value, tstamp, host_name, None)
+        self.send_metric(metric_name, value, tstamp_str, host_name, None)
 
         # system.load.*
         load_metric_names = ['system.load.1', 'system.load.15', 'system.load.5',
@@ -282,20 +512,21 @@ class emitter(object):
             if metric_name not in message:
                 continue
             value = message[metric_name]
-            self.send_metric(metric_name, value, tstamp, host_name, None)
+            self.send_metric(metric_name, value, tstamp_str, host_name, None)
 
     def parse_meta_tags(self, message):
         """
         Parses the meta dict from the JSON message, looking for any existing
-        keys from the wf_meta_tags user configuration. Stores any as key
-        value pairs in an instance variable
+        keys from the wf_meta_tags user configuration. Stores any with a
+        string value as key value pairs in an instance variable; a key whose
+        value is not a string (e.g., null) removes that point tag
         NOTE: these are only passed on the first request (or perhaps
         only periodically?).  If nothing is in the mta dictionary then
         this function does nothing.
         Arguments:
         message - the JSON message object from the request
         Side Effects:
-        self.point_tags set
+        self.point_tags set (and the cached point tag string invalidated)
         """
         if 'meta' not in message:
             return
@@ -303,8 +534,14 @@ class emitter(object):
         meta = message['meta']
 
         for tag in self.meta_tags:
-            if tag in meta:
-                self.point_tags[tag] = meta[tag]
+            if tag not in meta:
+                continue
+            value = meta[tag]
+            if isinstance(value, basestring):
+                self.point_tags[tag] = value
+                self._point_tags_dirty = True
+            elif self.point_tags.pop(tag, None) is not None:
+                self._point_tags_dirty = True
 
     def parse_host_tags(self, message):
         """
@@ -317,7 +554,7 @@ class emitter(object):
         message - the JSON message object from the request
         Side Effects:
         self.source_tags set
-        self.point_tags set
+        self.point_tags set (and the cached point tag string invalidated)
         """
 
         if 'host-tags' not in message:
@@ -329,22 +566,18 @@ class emitter(object):
 
         for tag in host_tags['system']:
             self.source_tags.append(tag)
-            if ':' in tag:
-                parts = tag.split(':')
-                k = self.sanitize(parts[0])
-                v = self.sanitize(parts[1])
+            k, sep, v = tag.partition(':')
+            if sep:
+                k = self.sanitize(k)
+                v = self.sanitize(v)
                 self.point_tags[k] = v
+                self._point_tags_dirty = True
 
     @staticmethod
     def sanitize(s):
         """
         Removes any `[ ] "' characters from the input screen
         """
-        replace_map = {
-            '[': '',
-            ']': '',
-            '"': ''
-        }
-        for search, replace in replace_map.iteritems():
-            s = s.replace(search, replace)
-        return s
+        if isinstance(s, unicode):
+            return s.translate(_SANITIZE_UNICODE_TABLE)
+        return s.translate(None, _SANITIZE_CHARS)